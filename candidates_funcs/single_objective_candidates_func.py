@@ -1,6 +1,12 @@
 from typing import Optional
+import warnings
+from copy import deepcopy
+from functools import wraps
 import torch
 from botorch.fit import fit_gpytorch_mll, fit_fully_bayesian_model_nuts
+from botorch.exceptions import InputDataWarning
+from botorch.exceptions.errors import ModelFittingError
+from linear_operator.utils.errors import NotPSDError
 from botorch.optim import optimize_acqf
 from botorch.sampling.normal import SobolQMCNormalSampler
 from botorch.utils.transforms import normalize, unnormalize
@@ -21,6 +27,7 @@ from gpytorch.kernels import MaternKernel, RBFKernel, ScaleKernel
 from gpytorch.priors.torch_priors import GammaPrior, LogNormalPrior
 from botorch.acquisition.objective import PosteriorTransform
 from botorch.acquisition.analytic import AnalyticAcquisitionFunction
+from botorch.acquisition.acquisition import AcquisitionFunction
 from gpytorch.kernels import MaternKernel, RBFKernel, ScaleKernel
 from gpytorch.priors.torch_priors import GammaPrior, LogNormalPrior
 from math import log, sqrt
@@ -69,7 +76,7 @@ class ThompsonSampling(AnalyticAcquisitionFunction):
         n_dim = bounds.shape[-1]
         grids_for_each_dim = []
         for i in range(n_dim):
-            grids_for_each_dim.append(torch.linspace(bounds[0, i], bounds[1, i], delta))
+            grids_for_each_dim.append(torch.linspace(bounds[0, i], bounds[1, i], delta, device=bounds.device))
         X = torch.cartesian_prod(*grids_for_each_dim)  # 値域のグリッドを作成
 
         # 事後分布生成
@@ -80,12 +87,100 @@ class ThompsonSampling(AnalyticAcquisitionFunction):
         self.candidates = X[torch.argmax(Y)]  # GPからのサンプリングされた関数上での最適点を取得
 
     def forward(self, X: torch.Tensor) -> torch.Tensor:
-        return -((X - self.candidates) ** 2).sum(axis=(1, 2))
+        return -((X - self.candidates) ** 2).sum(dim=(1, 2))
+
+
+def _optimize_acqf(acq_function: AcquisitionFunction, bounds: torch.Tensor, **kwargs):
+    """optimize_acqfのラッパー.
+
+    GPUのメモリが不足した場合は, 獲得関数(モデル含む)をCPUに移して最適化をやり直す.
+    ※ 獲得関数はin-placeで移動するため, やり直し後は元のデバイスに戻す.
+    """
+    try:
+        return optimize_acqf(acq_function=acq_function, bounds=bounds, **kwargs)
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        # X_pendingはbufferではないため, .cpu()では移動されない
+        X_pending = getattr(acq_function, 'X_pending', None)
+        acq_function.cpu()
+        if X_pending is not None:
+            acq_function.set_X_pending(X_pending.cpu())
+        if 'equality_constraints' in kwargs:
+            kwargs['equality_constraints'] = [(i.cpu(), c.cpu(), v) for i, c, v in kwargs['equality_constraints']]
+        try:
+            candidates, acq_value = optimize_acqf(acq_function=acq_function, bounds=bounds.cpu(), **kwargs)
+        finally:
+            acq_function.to(bounds.device)
+            if X_pending is not None:
+                acq_function.set_X_pending(X_pending)
+        return candidates.to(bounds.device), acq_value.to(bounds.device)
+
+
+_FITTED_STATES: dict[str, tuple[torch.Tensor, torch.Tensor, dict]] = {}  # candidates_funcごとの直前の学習データと学習済みパラメータ
+
+
+def _fit_gpytorch_mll_cached(mll: ExactMarginalLogLikelihood, name: str, train_obj: torch.Tensor):
+    """fit_gpytorch_mllのラッパー.
+
+    直前と同じ学習データで呼ばれた場合は, 学習済みのパラメータを読み込んでGPの学習を省略する.
+    バッチ探索では同一ステップ内でbatch_size回askするが, 学習データは変わらないため学習は1回で済む.
+
+    Args:
+        mll (ExactMarginalLogLikelihood): 学習対象のモデルを持つ周辺尤度
+        name (str): キャッシュのキー (candidates_funcの名前)
+        train_obj (torch.Tensor): 観測データの目的関数の評価値 (n, obj_dim). 変換前の値で比較する
+
+    """
+    train_x = mll.model.train_inputs[0]
+    cached = _FITTED_STATES.get(name)
+    if cached is not None:
+        cached_x, cached_y, state_dict = cached
+        if (
+            cached_x.shape == train_x.shape
+            and cached_y.shape == train_obj.shape
+            and cached_x.dtype == train_x.dtype
+            and cached_x.device == train_x.device
+            and torch.equal(cached_x, train_x)
+            and torch.equal(cached_y, train_obj)
+        ):
+            mll.model.load_state_dict(state_dict)
+            mll.eval()
+            return
+
+    fit_gpytorch_mll(mll)
+    _FITTED_STATES[name] = (train_x.clone(), train_obj.clone(), deepcopy(mll.model.state_dict()))
+
+
+def _float32_with_fallback(candidates_func):
+    """candidates_funcをfloat32で実行するデコレータ.
+
+    コレスキー分解等が数値的に不安定で失敗した場合は, 元の精度(float64)で再実行する.
+    ※ float32の入力に対してBoTorchが毎回出すInputDataWarningは抑制する.
+    """
+
+    @wraps(candidates_func)
+    def wrapper(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds: torch.Tensor, pending_x):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', InputDataWarning)
+                candidates = candidates_func(
+                    train_x.to(torch.float32),
+                    train_obj.to(torch.float32),
+                    train_con,
+                    bounds.to(torch.float32),
+                    pending_x.to(torch.float32) if pending_x is not None else None,
+                )
+        except (NotPSDError, ModelFittingError):
+            candidates = candidates_func(train_x, train_obj, train_con, bounds, pending_x)
+        return candidates.to(train_x.dtype)
+
+    return wrapper
 
 
 ##################
 # candidates_func
 ##################
+@_float32_with_fallback
 def ei_dim_scaled_prior(
     train_x: torch.Tensor,
     train_obj: torch.Tensor,
@@ -125,15 +220,16 @@ def ei_dim_scaled_prior(
     )
 
     mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    _fit_gpytorch_mll_cached(mll, 'ei_dim_scaled_prior', train_obj)
 
     sampler = SobolQMCNormalSampler(sample_shape=torch.Size([128]))
-    acq_func = qExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler)
+    X_pending = normalize(pending_x, bounds=bounds) if pending_x is not None else None
+    acq_func = qExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler, X_pending=X_pending)
 
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
+    candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
@@ -146,6 +242,7 @@ def ei_dim_scaled_prior(
     return candidates
 
 
+@_float32_with_fallback
 def logei_dim_scaled_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pending_x):
     """Log Expected Improvementのモンテカルロ獲得関数.
 
@@ -171,15 +268,16 @@ def logei_dim_scaled_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train
     )
 
     mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    _fit_gpytorch_mll_cached(mll, 'logei_dim_scaled_prior', train_obj)
 
     sampler = SobolQMCNormalSampler(sample_shape=torch.Size([128]))
-    acq_func = qLogExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler)
+    X_pending = normalize(pending_x, bounds=bounds) if pending_x is not None else None
+    acq_func = qLogExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler, X_pending=X_pending)
 
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
+    candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
@@ -192,6 +290,7 @@ def logei_dim_scaled_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train
     return candidates
 
 
+@_float32_with_fallback
 def ei_gammma_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pending_x):
     """Expected Improvementのモンテカルロ獲得関数.
 
@@ -204,15 +303,16 @@ def ei_gammma_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, b
     )
 
     mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    _fit_gpytorch_mll_cached(mll, 'ei_gammma_prior', train_obj)
 
     sampler = SobolQMCNormalSampler(sample_shape=torch.Size([128]))
-    acq_func = qExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler)
+    X_pending = normalize(pending_x, bounds=bounds) if pending_x is not None else None
+    acq_func = qExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler, X_pending=X_pending)
 
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
+    candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
@@ -225,6 +325,7 @@ def ei_gammma_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, b
     return candidates
 
 
+@_float32_with_fallback
 def logei_gammma_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pending_x):
     """Expected Improvementのモンテカルロ獲得関数.
 
@@ -237,15 +338,16 @@ def logei_gammma_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train_con
     )
 
     mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    _fit_gpytorch_mll_cached(mll, 'logei_gammma_prior', train_obj)
 
     sampler = SobolQMCNormalSampler(sample_shape=torch.Size([128]))
-    acq_func = qLogExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler)
+    X_pending = normalize(pending_x, bounds=bounds) if pending_x is not None else None
+    acq_func = qLogExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler, X_pending=X_pending)
 
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
+    candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
@@ -258,13 +360,14 @@ def logei_gammma_prior(train_x: torch.Tensor, train_obj: torch.Tensor, train_con
     return candidates
 
 
+@_float32_with_fallback
 def lcb(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pending_x):
     """Lower Confidence Bound (LCB)."""
     train_x = normalize(train_x, bounds=bounds)
     model = SingleTaskGP(train_x, train_obj, outcome_transform=Standardize(m=train_obj.size(-1)))
 
     mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    _fit_gpytorch_mll_cached(mll, 'lcb', train_obj)
 
     # beta = torch.log(torch.Tensor([train_x.size()[0]]))[0]  # LCBのハイパラ
     acq_func = LCB(model=model, maximize=True)  # 獲得関数に自作のLCBを利用
@@ -272,7 +375,7 @@ def lcb(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pendi
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
+    candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
@@ -286,7 +389,10 @@ def lcb(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pendi
 
 
 def ei_saas(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pending_x):
-    """SAAS + EI."""
+    """SAAS + EI.
+
+    ※ NUTSによる学習はfloat32で失敗しても_float32_with_fallbackで検知できないため, float64のまま実行する.
+    """
     train_x = normalize(train_x, bounds=bounds)
     model = SaasFullyBayesianSingleTaskGP(
         train_x,
@@ -297,12 +403,13 @@ def ei_saas(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, p
     fit_fully_bayesian_model_nuts(model, warmup_steps=256, num_samples=128, thinning=16, disable_progbar=True)
 
     sampler = SobolQMCNormalSampler(sample_shape=torch.Size([128]))
-    acq_func = qExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler)
+    X_pending = normalize(pending_x, bounds=bounds) if pending_x is not None else None
+    acq_func = qExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler, X_pending=X_pending)
 
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
+    candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
@@ -315,6 +422,7 @@ def ei_saas(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, p
     return candidates
 
 
+@_float32_with_fallback
 def thompson_sampling(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pending_x):
     """トンプソンサンプリング."""
     train_x = normalize(train_x, bounds=bounds)
@@ -335,14 +443,14 @@ def thompson_sampling(train_x: torch.Tensor, train_obj: torch.Tensor, train_con,
         train_x, train_obj, outcome_transform=Standardize(m=train_obj.size(-1)), covar_module=covar_module
     )
     mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    _fit_gpytorch_mll_cached(mll, 'thompson_sampling', train_obj)
 
     acq_func = PathwiseThompsonSampling(model=model)
 
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
 
-    candidates, _ = optimize_acqf(
+    candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
@@ -356,6 +464,7 @@ def thompson_sampling(train_x: torch.Tensor, train_obj: torch.Tensor, train_con,
 
 
 ####　実験用
+@_float32_with_fallback
 def experimental(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, bounds, pending_x):
     """実験用."""
     train_x = normalize(train_x, bounds=bounds)
@@ -377,22 +486,23 @@ def experimental(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, boun
     )
 
     mll = ExactMarginalLogLikelihood(model.likelihood, model)
-    fit_gpytorch_mll(mll)
+    _fit_gpytorch_mll_cached(mll, 'experimental', train_obj)
 
+    # ※ 獲得関数の最適化では, batch_limit=num_restartsとして全リスタートを1回のforwardでまとめて評価する
     # まずはトンプソンサンプリングで候補点算出
     acq_func = PathwiseThompsonSampling(model=model)
     standard_bounds = torch.zeros_like(bounds)
     standard_bounds[1] = 1
-    ts_candidates, _ = optimize_acqf(
+    ts_candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
         num_restarts=10,
         raw_samples=512,
-        options={'batch_limit': 5, 'maxiter': 200},
+        options={'batch_limit': 10, 'maxiter': 200},
         sequential=True,
     )
-    ts_candidates = ts_candidates.detach().numpy()
+    ts_candidates = ts_candidates.detach().cpu().numpy()
 
     # length_scaleの下位5個を取得
     length_scale = model.covar_module.base_kernel.lengthscale.detach()
@@ -403,16 +513,19 @@ def experimental(train_x: torch.Tensor, train_obj: torch.Tensor, train_con, boun
     equality_constraints = []
     for i in fixed_indices:
         v = float(ts_candidates[0][i])
-        equality_constraints.append((torch.tensor([i]).int(), torch.tensor([1.0]).to(torch.float64), v))
+        indices = torch.tensor([i], device=train_x.device).int()
+        coefficients = torch.tensor([1.0], device=train_x.device).to(train_x.dtype)
+        equality_constraints.append((indices, coefficients, v))
     sampler = SobolQMCNormalSampler(sample_shape=torch.Size([128]))
-    acq_func = qExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler)
-    candidates, _ = optimize_acqf(
+    X_pending = normalize(pending_x, bounds=bounds) if pending_x is not None else None
+    acq_func = qExpectedImprovement(model=model, best_f=train_obj.max(), sampler=sampler, X_pending=X_pending)
+    candidates, _ = _optimize_acqf(
         acq_function=acq_func,
         bounds=standard_bounds,
         q=1,
         num_restarts=10,
         raw_samples=512,
-        options={'batch_limit': 5, 'maxiter': 200},
+        options={'batch_limit': 10, 'maxiter': 200},
         equality_constraints=equality_constraints,
         sequential=True,
     )
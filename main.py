@@ -1,5 +1,9 @@
 import optuna
 import os
+from typing import Any, Literal
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+import torch
 import numpy as np
 import polars as pl
 from enum import Enum
@@ -17,7 +21,8 @@ from candidates_funcs.single_objective_candidates_func import (
 )
 
 
-TargetFunction = Hartmann6 | StyblinskiTang | FiveWellPotentioal | Hartmann6Cat2 | SumOfSquares
+TargetFunction = Hartmann6 | StyblinskiTang | FiveWellPotentioal | Hartmann6Cat2 | SumOfSquares | SumOfDiffSquares
+Direction = Literal['minimize', 'maximize']
 
 
 class SamplerName(str, Enum):
@@ -34,35 +39,83 @@ class SamplerName(str, Enum):
     EXPERIMENTAL = 'experimental'
 
 
+CANDIDATES_FUNCS = {
+    SamplerName.LCB: lcb,
+    SamplerName.EIGammaPrior: ei_gammma_prior,
+    SamplerName.EIDimScaledPrior: ei_dim_scaled_prior,
+    SamplerName.EISaas: ei_saas,
+    SamplerName.LogEIGammaPrior: logei_gammma_prior,
+    SamplerName.LogEIDimScaledPrior: logei_dim_scaled_prior,
+    SamplerName.ThompsonSampling: thompson_sampling,
+    SamplerName.EXPERIMENTAL: experimental,
+}
+# pending_xを考慮しない獲得関数. バッチ探索ではほぼ同じ点が返るため, batch_size=1のみ許可
+SEQUENTIAL_ONLY_SAMPLERS = {SamplerName.LCB, SamplerName.ThompsonSampling}
+
+
+FLOAT, CATEGORICAL = 0, 1  # _compile_spaceで用いる分布の種類
+Space = tuple[tuple[str, int, Any, Any], ...]
+
+
+def _compile_space(distributions: dict[str, Any]) -> Space:
+    """探索空間を(特徴量名, 分布の種類, low or choices, high or None)のタプルに変換.
+
+    Args:
+        distributions (Dict[str, optuna.distributions]): 探索空間
+
+    """
+    space: list[tuple[str, int, Any, Any]] = []
+    for feature, dist in distributions.items():
+        if isinstance(dist, optuna.distributions.FloatDistribution):
+            space.append((feature, FLOAT, dist.low, dist.high))
+        elif isinstance(dist, optuna.distributions.CategoricalDistribution):
+            space.append((feature, CATEGORICAL, dist.choices, None))
+        else:
+            raise ValueError(f'Unsupported distribution for {feature}: {type(dist).__name__}')
+    return tuple(space)
+
+
 class Optimizer:
     """最適化クラス."""
 
-    def __init__(self, sampler_name: SamplerName):
+    device: torch.device
+    sampler: optuna.samplers.BaseSampler
+    study: optuna.Study
+    trials: list[optuna.trial.Trial]
+    _space: Space
+    _storage: optuna.storages.InMemoryStorage
+
+    def __init__(self, sampler_name: SamplerName, device: torch.device | None = None) -> None:
+        """初期化.
+
+        Args:
+            sampler_name (SamplerName): 最適化手法
+            device (torch.device | None): GP学習・獲得関数最適化を行うデバイス. Noneの場合はGPUが使えればGPUを利用
+
+        """
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.device = device
+        self.trials = []  # 評価待ちのtrial
+        self._space = ()  # 変換済みの探索空間 (_prepare_dispatchで作成)
+        self._storage = optuna.storages.InMemoryStorage()
+
         if sampler_name == SamplerName.TPE:
-            self.sampler = optuna.samplers.TPESampler()
-        elif sampler_name == SamplerName.LCB:
-            self.sampler = optuna.integration.BoTorchSampler(candidates_func=lcb)
-        elif sampler_name == SamplerName.EIGammaPrior:
-            self.sampler = optuna.integration.BoTorchSampler(candidates_func=ei_gammma_prior)
-        elif sampler_name == SamplerName.EIDimScaledPrior:
-            self.sampler = optuna.integration.BoTorchSampler(candidates_func=ei_dim_scaled_prior)
-        elif sampler_name == SamplerName.EISaas:
-            self.sampler = optuna.integration.BoTorchSampler(candidates_func=ei_saas)
-        elif sampler_name == SamplerName.LogEIGammaPrior:
-            self.sampler = optuna.integration.BoTorchSampler(candidates_func=logei_gammma_prior)
-        elif sampler_name == SamplerName.LogEIDimScaledPrior:
-            self.sampler = optuna.integration.BoTorchSampler(candidates_func=logei_dim_scaled_prior)
-        elif sampler_name == SamplerName.ThompsonSampling:
-            self.sampler = optuna.integration.BoTorchSampler(candidates_func=thompson_sampling)
-        elif sampler_name == SamplerName.EXPERIMENTAL:
-            self.sampler = optuna.integration.BoTorchSampler(candidates_func=experimental)
+            # バッチ探索時は評価待ちのtrialを仮の評価値で考慮する (逐次探索では評価待ちがないため影響なし)
+            self.sampler = optuna.samplers.TPESampler(constant_liar=True)
+        elif sampler_name in CANDIDATES_FUNCS:
+            # バッチ探索時は評価待ちの点をpending_xとしてcandidates_funcに渡す
+            self.sampler = optuna.integration.BoTorchSampler(
+                candidates_func=CANDIDATES_FUNCS[sampler_name], consider_running_trials=True, device=device
+            )
         else:
             pass
 
-    def _set_samples(self, Xs: np.ndarray, ys: np.ndarray, distributions: dict):
+    def _set_samples(self, Xs: np.ndarray, ys: np.ndarray, distributions: dict[str, Any]) -> None:
         """studyに観測データを登録.
 
         ※ Tell_and_Askのインターフェースを利用.
+        ※ 事前に_prepare_dispatchで探索空間を登録しておくこと.
 
         Args:
             Xs (np.ndarray): shape=(n, x_dim).
@@ -70,58 +123,100 @@ class Optimizer:
             distributions (Dict[str, optuna.distributions]): 探索空間
 
         """
-        features = list(distributions.keys())
+        features = tuple(feature for feature, _, _, _ in self._space)
         for X, y in zip(Xs, ys):
-            params = {}
-            for feature, x in zip(features, X):
-                params[feature] = x
-            trial = optuna.trial.create_trial(params=params, distributions=distributions, value=y[0])
+            params = dict(zip(features, X.tolist()))
+            trial = optuna.trial.create_trial(params=params, distributions=distributions, value=float(y[0]))
             self.study.add_trial(trial)
 
-    def create_study(self, direction):
-        self.study = optuna.create_study(direction=direction, sampler=self.sampler)
+    def create_study(self, direction: Direction) -> None:
+        """studyを作成.
 
-    def get_candidate(self, Xs: np.ndarray, ys: np.ndarray, distributions: dict):
-        """候補点を取得.
+        ※ storageはOptimizerで保持し, 再度呼ばれた場合は既存のstudyを読み込む.
+        """
+        self.study = optuna.create_study(
+            storage=self._storage, sampler=self.sampler, study_name='run', direction=direction, load_if_exists=True
+        )
+
+    def _prepare_dispatch(self, distributions: dict[str, Any]) -> None:
+        """探索空間を事前に変換して保持.
 
         Args:
-            Xs (np.ndarray): shape=(n, x_dim)
-            ys (np.ndarray): shape=(n, y_dim)
             distributions (Dict[str, optuna.distributions]): 探索空間
 
         """
-        self._set_samples(Xs, ys, distributions)
-        trial = self.study.ask()
-        new_X = []
-        for feature, dist in distributions.items():
-            if type(dist) is optuna.distributions.FloatDistribution:
-                new_X.append(trial.suggest_float(feature, dist.low, dist.high))
-            elif type(dist) is optuna.distributions.CategoricalDistribution:
-                new_X.append(trial.suggest_categorical(feature, dist.choices))
-        new_X = np.array(new_X)
-        return new_X.reshape(1, new_X.shape[0])
+        self._space = _compile_space(distributions)
+
+    def get_candidate(self, batch_size: int = 1) -> np.ndarray:
+        """候補点を取得.
+
+        ※ batch_size回askし, 評価待ちの点を考慮しながら候補点を取得. 評価値はtellで登録する.
+        ※ 事前に_prepare_dispatchで探索空間を登録しておくこと.
+
+        Args:
+            batch_size (int): 1回に取得する候補点の数
+
+        Returns:
+            np.ndarray: shape=(batch_size, x_dim)
+
+        """
+        self.trials = []
+        new_X = np.empty((batch_size, len(self._space)))
+        for i in range(batch_size):
+            trial = self.study.ask()
+            for d, (feature, kind, a, b) in enumerate(self._space):
+                if kind == FLOAT:
+                    new_X[i, d] = trial.suggest_float(feature, a, b)
+                else:
+                    new_X[i, d] = trial.suggest_categorical(feature, a)
+            self.trials.append(trial)
+        return new_X
+
+    def tell(self, ys: np.ndarray) -> None:
+        """get_candidateで取得した候補点の評価値を登録.
+
+        Args:
+            ys (np.ndarray): shape=(batch_size, y_dim)
+
+        """
+        for trial, y in zip(self.trials, ys, strict=True):
+            self.study.tell(trial, float(y[0]))
+        self.trials = []
 
 
 def run_optimization(
     func: TargetFunction,
-    direction: str,
+    direction: Direction,
     X_init: np.ndarray,
     y_init: np.ndarray,
     sampler_name: SamplerName,
     iters: int = 100,
-):
-    """探索を実行."""
-    sampler = Optimizer(sampler_name)
-    Xs = X_init.copy()
-    ys = y_init.copy()
-
-    distributions = func.distributions
-    for _ in tqdm(range(iters)):
-        sampler.create_study(direction)
-        new_X = sampler.get_candidate(Xs, ys, distributions)
+    device: torch.device | None = None,
+    batch_size: int = 1,
+) -> np.ndarray:
+    """探索を実行.
+
+    ※ studyは1度だけ作成し, 新たな観測データのみをtellで追加する.
+    ※ batch_size点ずつ候補点を取得し, まとめて評価する.
+    """
+    if batch_size > 1 and sampler_name in SEQUENTIAL_ONLY_SAMPLERS:
+        raise ValueError(f'{sampler_name.value} does not support batch_size > 1')
+    sampler = Optimizer(sampler_name, device=device)
+    n_init: int = y_init.shape[0]
+    ys: np.ndarray = np.empty((n_init + iters, y_init.shape[1]))
+    ys[:n_init] = y_init
+    k: int = n_init
+
+    distributions: dict[str, Any] = func.distributions
+    sampler.create_study(direction)
+    sampler._prepare_dispatch(distributions)
+    sampler._set_samples(X_init, y_init, distributions)
+    for t in tqdm(range(0, iters, batch_size)):
+        new_X = sampler.get_candidate(batch_size=min(batch_size, iters - t))
         new_y = func.f(new_X)
-        Xs = np.concatenate([Xs, new_X])
-        ys = np.concatenate([ys, new_y])
+        ys[k : k + new_y.shape[0]] = new_y
+        k += new_y.shape[0]
+        sampler.tell(new_y)
     return ys
 
 
@@ -141,17 +236,56 @@ def get_target_function(exp_name: str) -> TargetFunction:
         return SumOfDiffSquares(dim=40)
     elif exp_name == 'SumOfSquares40':
         return SumOfSquares(dim=40)
+    raise ValueError(f'Unknown experiment: {exp_name}')
+
+
+def _run_trial(
+    j: int,
+    f: TargetFunction,
+    direction: Direction,
+    use_methods: list[SamplerName],
+    serch_num: int,
+    init_num: int,
+    batch_size: int,
+) -> tuple[int, dict[str, np.ndarray]]:
+    """1試行分の実験を実行.
+
+    ※ 試行ごとに別プロセスで実行されるため, スレッド数は1に制限する.
+    """
+    torch.set_num_threads(1)
+    optuna.logging.disable_default_handler()
+
+    print(f'Start trial:{j}')
+    serch_fs: dict[str, np.ndarray] = {}
+
+    # 初期点ランダムに10点
+    X_init = f.random_x(init_num)
+    y_init = f.f(X_init)
+
+    # ランダム探索
+    ys_random = np.concatenate([y_init, f.f(f.random_x(serch_num))])
+    serch_fs['Random'] = ys_random.squeeze()
 
+    # 各手法で探索
+    for method in use_methods:
+        print(f'Start optimization using {method.value} (trial:{j})')
+        ys = run_optimization(f, direction, X_init, y_init, method, serch_num, batch_size=batch_size)
+        serch_fs[method.value] = ys.squeeze()
+    return j, serch_fs
 
-def main():
+
+def main() -> None:
     """実験実行."""
+    optuna.logging.disable_default_handler()
+
     #### 実験設定 #####
     exp_name = 'SumOfSquares40'
 
-    direction = 'minimize'
+    direction: Direction = 'minimize'
     EXP_NUM = 3  # 実験回数
     SERCH_NUM = 100  # 観測回数
     INIT_NUM = 10  # 初期点の数
+    BATCH_SIZE = 1  # 1回のaskで取得する候補点の数
     # use_methods = [SamplerName.EXPERIMENTAL]
     use_methods = [SamplerName.EIGammaPrior, SamplerName.EIDimScaledPrior, SamplerName.LogEIGammaPrior, SamplerName.LogEIDimScaledPrior]
     ##################
@@ -162,37 +296,24 @@ def main():
     # 目的関数取得
     f = get_target_function(exp_name)
 
-    for j in range(1, EXP_NUM + 1):
-        print(f'Start trial:{j}')
-        serch_fs = {}
-
-        # 初期点ランダムに10点
-        X_init = f.random_x()
-        y_init = f.f(X_init)
-        for _ in range(INIT_NUM - 1):
-            X = f.random_x()
-            y = f.f(X)
-            X_init = np.concatenate([X_init, X])
-            y_init = np.concatenate([y_init, y])
-
-        # ランダム探索
-        ys_random = y_init.copy()
-        for _ in range(SERCH_NUM):
-            new_y = f.f(f.random_x())
-            ys_random = np.concatenate([ys_random, new_y])
-        serch_fs['Random'] = ys_random.squeeze()
-
-        # 各手法で探索
-        for method in use_methods:
-            print(f'Start optimization using {method.value}')
-            ys = run_optimization(f, direction, X_init, y_init, method, SERCH_NUM)
-            serch_fs[method.value] = ys.squeeze()
-
-        # 探索結果を格納
-        df = pl.DataFrame(serch_fs)
-        df.write_csv(f'exp_result/{exp_name}/run_{j}.csv')
+    # 各試行は独立なので並列に実行 (CUDAとの併用のためspawnを利用. 乱数状態もプロセスごとに独立になる)
+    args = [(j, f, direction, use_methods, SERCH_NUM, INIT_NUM, BATCH_SIZE) for j in range(1, EXP_NUM + 1)]
+    # 探索結果のCSV保存はバックグラウンドのスレッドで行い, 他の試行の実行と重ねる
+    with ThreadPoolExecutor(max_workers=2) as io_pool:
+        futures = []
+        with mp.get_context('spawn').Pool(processes=min(EXP_NUM, os.cpu_count() or 1)) as pool:
+            results = [pool.apply_async(_run_trial, arg) for arg in args]
+            for result in results:
+                j, serch_fs = result.get()
+                # 各列が連続したメモリになるよう(列数, 観測数)で積んでDataFrameに変換
+                cols = ['Random'] + [method.value for method in use_methods]
+                data = np.stack([serch_fs[col] for col in cols])
+                df = pl.from_numpy(data, schema=cols, orient='col')
+                futures.append(io_pool.submit(df.write_csv, f'exp_result/{exp_name}/run_{j}.csv'))
+        # 書き込みに失敗した場合は例外を送出する
+        for future in futures:
+            future.result()
 
 
 if __name__ == '__main__':
-    optuna.logging.disable_default_handler()
     main()
@@ -1,21 +1,12 @@
 import polars as pl
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
 import japanize_matplotlib
 import numpy as np
 from collections import defaultdict
 
 
-def get_best_ys(ys):
-    """ """
-    best_y = np.inf
-    best_ys = []
-    for y in ys:
-        if y < best_y:
-            best_y = y
-        best_ys.append(best_y)
-    return best_ys
-
-
 if __name__ == '__main__':
     exp_name = 'SumOfSquares40'
 
@@ -24,23 +15,39 @@ if __name__ == '__main__':
     # 全施行プロット
     fig = plt.figure(figsize=(25, 6))
     # fig.suptitle(f'{exp_name}')
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
     for j in range(1, 4):
         df = pl.read_csv(f'exp_result/{exp_name}/run_{j}.csv')
-        for col in df.columns:
-            ys = df[col].to_list()
-            ys = ys[0:]
-            plt.subplot(1, 3, j)
-            plt.title(f'Trial:{j}')
-            plt.scatter(range(len(ys)), ys, marker='.', label=f'{col} sample')
+        # 各時点までの最良値(最小値)の推移を全列まとめて計算
+        best_df = df.lazy().select(pl.all().cummin()).collect()
+        col_colors = [colors[i % len(colors)] for i in range(len(df.columns))]
+
+        ax = plt.subplot(1, 3, j)
+        ax.set_title(f'Trial:{j}')
 
-            best_ys = get_best_ys(ys)
-            plt.plot(range(len(best_ys)), best_ys, label=f'{col}')
+        # 全列の観測値を1回のscatterで描画
+        ys = df.to_numpy()  # shape=(n, 列数)
+        xs = np.arange(ys.shape[0])
+        point_colors = [color for color in col_colors for _ in range(ys.shape[0])]
+        ax.scatter(np.tile(xs, ys.shape[1]), ys.T.ravel(), marker='.', c=point_colors)
 
+        # 全列の最良値の推移を1つのLineCollectionで描画
+        best_ys = best_df.to_numpy()
+        segs = [np.column_stack([xs, best_ys[:, i]]) for i in range(best_ys.shape[1])]
+        ax.add_collection(LineCollection(segs, colors=col_colors))
+        ax.autoscale_view()
+
+        for i, col in enumerate(df.columns):
             best_ys_ = col2best_ys.get(col, [])
-            best_ys_.append(best_ys)
+            best_ys_.append(best_ys[:, i])
             col2best_ys[col] = best_ys_
 
-    plt.legend(loc='upper right')
+    # 凡例はまとめて描画したartistから作れないため, 列ごとにダミーのartistを作成
+    handles = []
+    for col, color in zip(df.columns, col_colors, strict=True):
+        handles.append(Line2D([], [], color=color, marker='.', linestyle='None', label=f'{col} sample'))
+        handles.append(Line2D([], [], color=color, label=f'{col}'))
+    plt.legend(handles=handles, loc='upper right')
     plt.tight_layout()
     plt.savefig(f'exp_result/{exp_name}/{exp_name}_all.png')
 
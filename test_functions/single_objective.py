@@ -1,4 +1,3 @@
-import random
 import numpy as np
 from optuna.distributions import FloatDistribution, CategoricalDistribution
 
@@ -22,14 +21,14 @@ class Hartmann6:
         """f.
 
         Args:
-            xx (np.ndarray): 入力. xx.shape=(1, 6)
+            xx (np.ndarray): 入力. xx.shape=(n, 6)
 
         Returns:
-            np.ndarray: 出力. shape=(1, 1)
+            np.ndarray: 出力. shape=(n, 1)
 
         """
-        if xx.shape != (1, 6):
-            raise InputError('入力次元エラー. shape=(1, 6) is required')
+        if xx.ndim != 2 or xx.shape[1] != 6:
+            raise InputError('入力次元エラー. shape=(n, 6) is required')
 
         n = xx.shape[0]
         y = np.zeros(n)
@@ -69,13 +68,16 @@ class Hartmann6:
         else:
             noise = np.random.normal(0, self.sd, n)
 
-        return (y + noise).reshape(1, 1)
+        return (y + noise).reshape(n, 1)
 
-    def random_x(self) -> np.ndarray:
-        """入力空間の点をランダムに1点取得."""
-        x = np.random.uniform(low=0.0, high=1.0, size=6)
-        x = x.reshape(1, x.shape[0])
-        return x
+    def random_x(self, n: int = 1) -> np.ndarray:
+        """入力空間の点をランダムにn点取得.
+
+        Returns:
+            np.ndarray: shape=(n, 6)
+
+        """
+        return np.random.uniform(low=0.0, high=1.0, size=(n, 6))
 
 
 class Hartmann6Cat2:
@@ -112,12 +114,12 @@ class Hartmann6Cat2:
     def f(self, xx: np.ndarray) -> np.ndarray:
         """."""
         xx = np.copy(xx)
-        if xx.shape != (1, 6):
-            raise InputError('入力次元エラー. shape=(1, 6) is required')
+        if xx.ndim != 2 or xx.shape[1] != 6:
+            raise InputError('入力次元エラー. shape=(n, 6) is required')
 
         # カテゴリ変数の次元を置換
-        xx[0][0] = self.x0_map[xx[0][0]]
-        xx[0][3] = self.x3_map[xx[0][3]]
+        xx[:, 0] = [self.x0_map[x] for x in xx[:, 0]]
+        xx[:, 3] = [self.x3_map[x] for x in xx[:, 3]]
 
         n = xx.shape[0]
         y = np.zeros(n)
@@ -155,14 +157,19 @@ class Hartmann6Cat2:
         else:
             noise = np.random.normal(0, self.sd, n)
 
-        return (y + noise).reshape(1, 1)
+        return (y + noise).reshape(n, 1)
 
-    def random_x(self):
-        """."""
-        x = np.random.uniform(low=0.0, high=1.0, size=6)
-        x[0] = random.choice(list(self.x0_map.keys()))
-        x[3] = random.choice(list(self.x3_map.keys()))
-        return x.reshape(1, x.shape[0])
+    def random_x(self, n: int = 1) -> np.ndarray:
+        """入力空間の点をランダムにn点取得.
+
+        Returns:
+            np.ndarray: shape=(n, 6)
+
+        """
+        x = np.random.uniform(low=0.0, high=1.0, size=(n, 6))
+        x[:, 0] = np.random.choice(list(self.x0_map.keys()), size=n)
+        x[:, 3] = np.random.choice(list(self.x3_map.keys()), size=n)
+        return x
 
 
 class StyblinskiTang:
@@ -177,23 +184,26 @@ class StyblinskiTang:
         """f.
 
         Args:
-            xx (np.ndarray): 入力. xx.shape=(1, x_dim)
+            xx (np.ndarray): 入力. xx.shape=(n, x_dim)
 
         Returns:
-            np.ndarray: 出力. shape=(1, 1)
+            np.ndarray: 出力. shape=(n, 1)
 
         """
-        if xx.shape != (1, self.dim):
-            raise InputError(f'入力次元エラー. shape=(1, {self.dim}) is required')
-        xx_ = np.squeeze(xx)
+        if xx.ndim != 2 or xx.shape[1] != self.dim:
+            raise InputError(f'入力次元エラー. shape=(n, {self.dim}) is required')
 
-        a = (1 / 2) * sum([x**4 - 16 * x**2 + 5 * x for x in xx_])
-        return np.array([a]).reshape(1, 1)
+        a = (1 / 2) * np.sum(xx**4 - 16 * xx**2 + 5 * xx, axis=1)
+        return a.reshape(-1, 1)
 
-    def random_x(self):
-        """."""
-        x = np.random.uniform(low=-5.0, high=5.0, size=self.dim)
-        return x.reshape(1, x.shape[0])
+    def random_x(self, n: int = 1) -> np.ndarray:
+        """入力空間の点をランダムにn点取得.
+
+        Returns:
+            np.ndarray: shape=(n, x_dim)
+
+        """
+        return np.random.uniform(low=-5.0, high=5.0, size=(n, self.dim))
 
 
 class FiveWellPotentioal:
@@ -206,15 +216,15 @@ class FiveWellPotentioal:
         """f.
 
         Args:
-            xx (np.ndarray): 入力. xx.shape=(1, 2)
+            xx (np.ndarray): 入力. xx.shape=(n, 2)
 
         Returns:
-            np.ndarray: 出力. shape=(1,1)
+            np.ndarray: 出力. shape=(n, 1)
 
         """
-        if xx.shape != (1, 2):
-            raise InputError('入力次元エラー. shape=(1, 2) is required')
-        xx_ = np.squeeze(xx)
+        if xx.ndim != 2 or xx.shape[1] != 2:
+            raise InputError('入力次元エラー. shape=(n, 2) is required')
+        xx_ = xx.T
         f = (1 + 0.0001 * (xx_[0] ** 2 + xx_[1] ** 2) ** (1.2)) * (
             1
             - (1 / (1 + 0.05 * (xx_[0] ** 2 + (xx_[1] - 10) ** 2)))
@@ -223,12 +233,16 @@ class FiveWellPotentioal:
             - (2 / (1 + 0.05 * ((xx_[0] - 5) ** 2 + (xx_[1] + 10) ** 2)))
             - (1 / (1 + 0.1 * ((xx_[0] + 5) ** 2 + (xx_[1] + 10) ** 2)))
         )
-        return np.array(f).reshape(1, 1)
+        return np.array(f).reshape(-1, 1)
+
+    def random_x(self, n: int = 1) -> np.ndarray:
+        """入力空間の点をランダムにn点取得.
+
+        Returns:
+            np.ndarray: shape=(n, 2)
 
-    def random_x(self):
-        """ """
-        x = np.random.uniform(low=-20.0, high=20.0, size=2)
-        return x.reshape(1, x.shape[0])
+        """
+        return np.random.uniform(low=-20.0, high=20.0, size=(n, 2))
 
 
 class Ackley:
@@ -249,21 +263,24 @@ class SumOfDiffSquares:
         """f.
 
         Args:
-            xx (np.ndarray): 入力. xx.shape=(1, x_dim)
+            xx (np.ndarray): 入力. xx.shape=(n, x_dim)
 
         Returns:
-            np.ndarray: 出力. shape=(1, 1)
+            np.ndarray: 出力. shape=(n, 1)
 
         """
-        if xx.shape != (1, self.dim):
-            raise InputError(f'入力次元エラー. shape=(1, {self.dim}) is required')
-        xx_ = np.squeeze(xx)
-        return np.sum((xx_ - self.r) ** 2).reshape(1, 1)
+        if xx.ndim != 2 or xx.shape[1] != self.dim:
+            raise InputError(f'入力次元エラー. shape=(n, {self.dim}) is required')
+        return np.sum((xx - self.r) ** 2, axis=1).reshape(-1, 1)
 
-    def random_x(self):
-        """."""
-        x = np.random.uniform(low=0.0, high=1.0, size=self.dim)
-        return x.reshape(1, x.shape[0])
+    def random_x(self, n: int = 1) -> np.ndarray:
+        """入力空間の点をランダムにn点取得.
+
+        Returns:
+            np.ndarray: shape=(n, x_dim)
+
+        """
+        return np.random.uniform(low=0.0, high=1.0, size=(n, self.dim))
 
 
 class SumOfSquares:
@@ -277,20 +294,23 @@ class SumOfSquares:
         """f.
 
         Args:
-            xx (np.ndarray): 入力. xx.shape=(1, x_dim)
+            xx (np.ndarray): 入力. xx.shape=(n, x_dim)
 
         Returns:
-            np.ndarray: 出力. shape=(1, 1)
+            np.ndarray: 出力. shape=(n, 1)
 
         """
-        if xx.shape != (1, self.dim):
-            raise InputError(f'入力次元エラー. shape=(1, {self.dim}) is required')
-        xx_ = np.squeeze(xx)
-        xx_square = xx_**2
+        if xx.ndim != 2 or xx.shape[1] != self.dim:
+            raise InputError(f'入力次元エラー. shape=(n, {self.dim}) is required')
+        xx_square = xx**2
         i_s = np.array(list(range(1, self.dim+1)))
-        return np.sum((i_s * xx_square) ** 2).reshape(1, 1)
+        return np.sum((i_s * xx_square) ** 2, axis=1).reshape(-1, 1)
 
-    def random_x(self):
-        """."""
-        x = np.random.uniform(low=-10.0, high=10.0, size=self.dim)
-        return x.reshape(1, x.shape[0])
+    def random_x(self, n: int = 1) -> np.ndarray:
+        """入力空間の点をランダムにn点取得.
+
+        Returns:
+            np.ndarray: shape=(n, x_dim)
+
+        """
+        return np.random.uniform(low=-10.0, high=10.0, size=(n, self.dim))